@@ -4,58 +4,225 @@ Deep Socket.IO Streaming Server
 LangGraph의 다중 노드 그래프를 실행하고,
 각 단계별 이벤트를 Socket.IO로 스트리밍합니다.
 
+모델: ollama pull gemma3:12b-it-q4_K_M
 실행: python deep_streaming_server.py
 테스트: http://localhost:8000
 """
+import io
 import os
-import uuid
+import sys
+import gzip
+import time
+import queue
 import asyncio
+import hashlib
+import logging
+import logging.handlers
+from collections import OrderedDict
 from datetime import datetime
-from typing import TypedDict, List
+from typing import Iterator, TypedDict, List
 
+import httpx
+import orjson
 import socketio
 from aiohttp import web
 from dotenv import load_dotenv
 
 from langchain_ollama import ChatOllama
+from langgraph.config import get_stream_writer
 from langgraph.graph import StateGraph, START, END
 
+try:
+    import uvloop  # Windows 미지원
+except ImportError:
+    uvloop = None
+
 load_dotenv()
 
 # ============================================================
 # 설정
 # ============================================================
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
-MODEL_NAME = os.getenv("STREAMING_MODEL", "gemma3:12b")
+# 디코딩은 메모리 대역폭 병목 → 4bit 양자화 모델 (품질 우선이면 gemma3:12b-it-q8_0)
+MODEL_NAME = os.getenv("STREAMING_MODEL", "gemma3:12b-it-q4_K_M")
+
+# Mock DB 저장 지연 (초) - 데모에서 지연을 보고 싶으면 MOCKDB_DELAY=0.3
+MOCKDB_DELAY = float(os.getenv("MOCKDB_DELAY", "0"))
+
+# 토큰 emit 묶음 단위 (시간 / 개수 중 먼저 도달하는 쪽)
+TOKEN_FLUSH_INTERVAL = 0.016
+TOKEN_FLUSH_SIZE = 32
+
+# LLM 응답 캐시 크기 / 캐시 히트 응답을 토큰처럼 나눠 보낼 글자 수
+LLM_CACHE_SIZE = 1024
+CACHE_REPLAY_CHUNK = 8
+
+# 로그 레벨 - 노드/토큰 단위 로그는 DEBUG
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# 로그 출력은 QueueListener 스레드에서 처리 (이벤트 루프가 stdout 쓰기에 막히지 않도록)
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+_log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener = logging.handlers.QueueListener(
+    _log_queue, logging.StreamHandler(sys.stdout)
+)
+
+
+class _ORJSON:
+    """Socket.IO 패킷 인코딩용 json 모듈 대체 (orjson)"""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return orjson.dumps(obj).decode()  # Socket.IO는 str을 기대함
+
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
+
 
 # Socket.IO 서버
-sio = socketio.AsyncServer(async_mode="aiohttp", cors_allowed_origins="*")
+sio = socketio.AsyncServer(
+    async_mode="aiohttp", json=_ORJSON, cors_allowed_origins="*"
+)
 app = web.Application()
 sio.attach(app)
 
-# LLM
-llm = ChatOllama(model=MODEL_NAME, base_url=OLLAMA_URL, temperature=0.7)
+
+async def _start_logging(app):
+    _log_listener.start()
+
+
+async def _stop_logging(app):
+    _log_listener.stop()
+
+
+app.on_startup.append(_start_logging)
+app.on_cleanup.append(_stop_logging)
+
+# LLM - analyzer/generator가 keep-alive 연결을 재사용하도록 공유 클라이언트 설정
+llm = ChatOllama(
+    model=MODEL_NAME,
+    base_url=OLLAMA_URL,
+    temperature=0.7,
+    async_client_kwargs={
+        "timeout": 300,  # ollama 기본값은 무제한 → 응답이 멈춘 호출을 300초에서 끊음
+        "limits": httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60),
+    },
+)
+
+
+# ============================================================
+# LLM 응답 캐시 (노드 + 프롬프트 완전 일치)
+# ============================================================
+_llm_cache: OrderedDict = OrderedDict()
+_llm_inflight: dict = {}  # 진행 중인 LLM 호출 (같은 프롬프트의 동시 요청이 공유)
+
+
+def _replay(node_name: str, content: str):
+    """캐시/공유된 응답도 스트리밍처럼 보이도록 custom 스트림으로 나눠서 전송"""
+    writer = get_stream_writer()
+    for i in range(0, len(content), CACHE_REPLAY_CHUNK):
+        writer({"node": node_name, "content": content[i:i + CACHE_REPLAY_CHUNK]})
+
+
+async def cached_invoke(node_name: str, prompt: str) -> str:
+    """같은 노드에 같은 프롬프트가 오면 LLM 호출 없이 이전 응답을 반환"""
+    key = (node_name, hashlib.blake2b(prompt.encode(), digest_size=16).digest())
+    content = _llm_cache.get(key)
+    if content is not None:
+        _llm_cache.move_to_end(key)
+        _replay(node_name, content)
+        return content
+
+    # 같은 프롬프트를 다른 클라이언트가 처리 중이면 그 호출 결과를 함께 사용
+    task = _llm_inflight.get(key)
+    if task is not None:
+        content = (await asyncio.shield(task)).content
+        _replay(node_name, content)
+        return content
+
+    # 태스크는 현재 context를 복사하므로 토큰은 이 요청의 messages 스트림으로 나감
+    task = asyncio.create_task(llm.ainvoke(prompt))
+    _llm_inflight[key] = task
+    try:
+        content = (await asyncio.shield(task)).content
+    finally:
+        del _llm_inflight[key]
+
+    _llm_cache[key] = content
+    if len(_llm_cache) > LLM_CACHE_SIZE:
+        _llm_cache.popitem(last=False)
+    return content
 
 
 # ============================================================
 # Mock Database
 # ============================================================
+RECORD_FIELDS = ("id", "created_at", "user_input", "analysis", "response")
+
+# ULID 인코딩용 Crockford base32
+CROCKFORD32 = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+
 class MockDatabase:
+    """컬럼별 리스트로 저장 (레코드마다 dict를 만들지 않음)"""
+
     def __init__(self):
-        self.records: List[dict] = []
+        self.ids: List[str] = []
+        self.created_at: List[str] = []
+        self.user_inputs: List[str] = []
+        self.analyses: List[str] = []
+        self.responses: List[str] = []
+
+        # ID 카운터는 한 번만 랜덤 시드, 타임스탬프는 초 단위로 캐시
+        self._counter = int.from_bytes(os.urandom(10), "big")
+        self._last_sec = None
+        self._sec_iso = ""
+
+    def _new_id(self, ns: int) -> str:
+        """ULID 형식 ID - 48bit 밀리초 + 80bit 증가 카운터 (정렬 가능)"""
+        self._counter = (self._counter + 1) & ((1 << 80) - 1)
+        value = (ns // 1_000_000) << 80 | self._counter
+        chars = []
+        for _ in range(26):
+            chars.append(CROCKFORD32[value & 31])
+            value >>= 5
+        return "".join(reversed(chars))
+
+    def _timestamp(self, ns: int) -> str:
+        """datetime.now().isoformat()과 같은 형식 - 초가 바뀔 때만 포맷"""
+        sec, us = divmod(ns // 1000, 1_000_000)
+        if sec != self._last_sec:
+            self._last_sec = sec
+            self._sec_iso = datetime.fromtimestamp(sec).isoformat()
+        return f"{self._sec_iso}.{us:06d}"
 
     async def save(self, data: dict) -> dict:
-        await asyncio.sleep(0.3)  # DB 지연 시뮬레이션
-        record = {
-            "id": str(uuid.uuid4()),
-            "created_at": datetime.now().isoformat(),
-            **data
-        }
-        self.records.append(record)
-        return record
-
-    def get_all(self) -> List[dict]:
-        return self.records
+        if MOCKDB_DELAY:
+            await asyncio.sleep(MOCKDB_DELAY)  # DB 지연 시뮬레이션
+        ns = time.time_ns()
+        row = (
+            self._new_id(ns),
+            self._timestamp(ns),
+            data["user_input"],
+            data["analysis"],
+            data["response"],
+        )
+        self.ids.append(row[0])
+        self.created_at.append(row[1])
+        self.user_inputs.append(row[2])
+        self.analyses.append(row[3])
+        self.responses.append(row[4])
+        return dict(zip(RECORD_FIELDS, row))
+
+    def get_all(self) -> Iterator[dict]:
+        """레코드를 하나씩 dict로 만들어 반환"""
+        for row in zip(self.ids, self.created_at, self.user_inputs,
+                       self.analyses, self.responses):
+            yield dict(zip(RECORD_FIELDS, row))
 
 
 mock_db = MockDatabase()
@@ -71,34 +238,37 @@ class GraphState(TypedDict):
     saved_record: dict
 
 
-async def analyzer_node(state: GraphState) -> GraphState:
-    """[Node 1] 사용자 입력 분석"""
-    prompt = f"""다음 입력을 분석해주세요.
+# 프롬프트 고정 부분 - 매 요청 같은 바이트로 앞에 두어 Ollama 프롬프트(KV) 캐시가 재사용되도록 함
+ANALYZER_PREFIX = """다음 입력을 분석해주세요.
 - 주요 의도
 - 핵심 키워드
 - 감정 톤
 
-입력: {state["user_input"]}
+입력: """
+ANALYZER_SUFFIX = """
 
 간단히 분석해주세요."""
 
-    response = await llm.ainvoke(prompt)
-    return {"analysis": response.content}
+GENERATOR_PREFIX = """분석 결과를 바탕으로 친절하고 도움이 되는 응답을 작성해주세요.
+
+원본 입력: """
+
+
+async def analyzer_node(state: GraphState) -> GraphState:
+    """[Node 1] 사용자 입력 분석"""
+    prompt = ANALYZER_PREFIX + state["user_input"] + ANALYZER_SUFFIX
+
+    return {"analysis": await cached_invoke("analyzer", prompt)}
 
 
 async def generator_node(state: GraphState) -> GraphState:
     """[Node 2] 응답 생성"""
-    prompt = f"""분석 결과를 바탕으로 응답을 생성해주세요.
-
-원본 입력: {state["user_input"]}
+    prompt = f"""{GENERATOR_PREFIX}{state["user_input"]}
 
 분석 결과:
-{state["analysis"]}
+{state["analysis"]}"""
 
-친절하고 도움이 되는 응답을 작성해주세요."""
-
-    response = await llm.ainvoke(prompt)
-    return {"response": response.content}
+    return {"response": await cached_invoke("generator", prompt)}
 
 
 async def saver_node(state: GraphState) -> GraphState:
@@ -123,7 +293,143 @@ workflow.add_edge("saver", END)
 graph = workflow.compile()
 
 # 추적할 노드 이름
-NODE_NAMES = {"analyzer", "generator", "saver"}
+NODE_NAMES = frozenset({"analyzer", "generator", "saver"})
+
+# 고정 payload는 미리 만들어 재사용 (Socket.IO 인코딩은 payload를 변경하지 않음)
+_NODE_START = {n: {"node": n} for n in NODE_NAMES}
+_NODE_END = {n: {"node": n} for n in NODE_NAMES}
+_DONE_OK = {"success": True}
+
+
+def brief(obj, n: int = 500) -> str:
+    """repr(obj)[:n] 미리보기 - 전체 repr을 만들지 않고 n자에서 중단"""
+    if isinstance(obj, str):
+        return repr(obj[:n])[:n]
+    if not isinstance(obj, dict):
+        return repr(obj)[:n]
+
+    buf = io.StringIO()
+    buf.write("{")
+    for i, (key, value) in enumerate(obj.items()):
+        if i:
+            buf.write(", ")
+        buf.write(f"{key!r}: ")
+        remaining = n - buf.tell()
+        if remaining <= 0:
+            break
+        buf.write(brief(value, remaining))
+        if buf.tell() >= n:
+            break
+    else:
+        buf.write("}")
+    return buf.getvalue()[:n]
+
+
+# ============================================================
+# Token Buffer
+# ============================================================
+# 토큰 이벤트("t") payload = 노드 코드 1글자 + 내용 (JSON 객체 envelope 생략)
+NODE_CODE = {"analyzer": "1", "generator": "2", "saver": "3"}
+
+
+class TokenBuffer:
+    """LLM 토큰을 모아서 한 번에 emit (토큰마다 emit하는 비용 절감)"""
+
+    def __init__(self, sid: str):
+        self.sid = sid
+        self.node = None
+        self.parts: List[str] = []
+        self._wake = asyncio.Event()
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def append(self, node: str, content: str):
+        # 노드가 바뀌면 이전 노드의 토큰을 먼저 내보냄
+        if node != self.node:
+            await self.flush()
+            self.node = node
+        self.parts.append(content)
+        if len(self.parts) >= TOKEN_FLUSH_SIZE:
+            await self.flush()
+        else:
+            self._wake.set()
+
+    async def flush(self):
+        if not self.parts:
+            return
+        payload = NODE_CODE[self.node] + "".join(self.parts)
+        self.parts.clear()
+        await sio.emit("t", payload, to=self.sid)
+
+    async def close(self):
+        self._flusher.cancel()
+        try:
+            await self._flusher
+        except asyncio.CancelledError:
+            pass
+        await self.flush()
+
+    async def _flush_loop(self):
+        # 첫 토큰이 들어올 때까지 대기 → 유휴 상태에서는 타이머가 돌지 않음
+        while True:
+            await self._wake.wait()
+            await asyncio.sleep(TOKEN_FLUSH_INTERVAL)
+            self._wake.clear()
+            await self.flush()
+
+
+# ============================================================
+# Stream Handlers - (payload, sid, state)
+# ============================================================
+async def _h_token(payload, sid, state):
+    """LLM 토큰 스트리밍"""
+    chunk, metadata = payload
+    content = chunk.content
+    if content:
+        await state["tokens"].append(metadata["langgraph_node"], content)
+
+
+async def _h_cached(payload, sid, state):
+    """캐시된 LLM 응답 재생 (cached_invoke가 보낸 custom 이벤트)"""
+    await state["tokens"].append(payload["node"], payload["content"])
+
+
+async def _h_task(payload, sid, state):
+    """노드 시작/종료 - 시작 이벤트에만 "input"이 있음"""
+    node_name = payload["name"]
+    if "input" in payload:
+        await state["tokens"].flush()
+        logger.debug("  [NODE START] %s", node_name)
+        await sio.emit("node_start", _NODE_START[node_name], to=sid)
+
+    # 실패한 노드는 종료 이벤트 없이 넘어감 (오류는 chat()에서 error로 전송)
+    elif payload.get("error") is not None:
+        await state["tokens"].flush()
+
+    # saver - 저장된 레코드 미리보기와 DB 저장 이벤트
+    elif node_name == "saver":
+        output = payload["result"]
+        logger.debug("  [NODE END] saver")
+        await sio.emit("node_end", {
+            "node": "saver",
+            "output": brief(output)
+        }, to=sid)
+        logger.debug("  [DB SAVE] %s", output["saved_record"]["id"])
+        await sio.emit("db_save", output["saved_record"], to=sid)
+
+    # analyzer/generator 출력은 이미 토큰으로 전송됨
+    else:
+        await state["tokens"].flush()
+        logger.debug("  [NODE END] %s", node_name)
+        await sio.emit("node_end", _NODE_END[node_name], to=sid)
+
+
+# tasks: 노드 시작/종료 (그래프 노드만 전달됨), messages: LLM 토큰 (노드 이름은 metadata에 포함)
+# custom: 캐시 히트 시 재생되는 토큰
+HANDLERS = {
+    "tasks": _h_task,
+    "messages": _h_token,
+    "custom": _h_cached,
+}
 
 
 # ============================================================
@@ -131,71 +437,41 @@ NODE_NAMES = {"analyzer", "generator", "saver"}
 # ============================================================
 @sio.event
 async def connect(sid, environ):
-    print(f"[연결] {sid}")
+    logger.info("[연결] %s", sid)
     await sio.emit("connected", {"sid": sid}, to=sid)
 
 
 @sio.event
 async def disconnect(sid):
-    print(f"[연결 해제] {sid}")
+    logger.info("[연결 해제] %s", sid)
 
 
 @sio.event
 async def chat(sid, data):
-    """채팅 메시지 처리 - 전체 이벤트 스트리밍"""
+    """채팅 메시지 처리 - 노드/토큰 스트리밍"""
     user_input = data.get("message", "")
-    print(f"[{sid}] 입력: {user_input}")
+    logger.info("[%s] 입력: %s", sid, user_input)
 
-    current_node = None
+    state = {"tokens": TokenBuffer(sid)}
 
     try:
-        async for event in graph.astream_events(
+        async for mode, payload in graph.astream(
             {"user_input": user_input},
-            version="v2"
+            stream_mode=list(HANDLERS),
         ):
-            kind = event["event"]
-
-            # 노드 시작
-            if kind == "on_chain_start":
-                node_name = event.get("name", "")
-                if node_name in NODE_NAMES:
-                    current_node = node_name
-                    print(f"  [NODE START] {node_name}")
-                    await sio.emit("node_start", {"node": node_name}, to=sid)
-
-            # 노드 종료
-            elif kind == "on_chain_end":
-                node_name = event.get("name", "")
-                if node_name in NODE_NAMES:
-                    output = event.get("data", {}).get("output", {})
-                    print(f"  [NODE END] {node_name}")
-                    await sio.emit("node_end", {
-                        "node": node_name,
-                        "output": str(output)[:500]
-                    }, to=sid)
-
-                    # DB 저장 이벤트
-                    if node_name == "saver" and "saved_record" in output:
-                        print(f"  [DB SAVE] {output['saved_record']['id']}")
-                        await sio.emit("db_save", output["saved_record"], to=sid)
-
-            # LLM 토큰 스트리밍
-            elif kind == "on_chat_model_stream":
-                chunk = event.get("data", {}).get("chunk")
-                if chunk and chunk.content:
-                    await sio.emit("token", {
-                        "node": current_node,
-                        "content": chunk.content
-                    }, to=sid)
+            await HANDLERS[mode](payload, sid, state)
 
         # 완료
-        print(f"  [DONE]")
-        await sio.emit("done", {"success": True}, to=sid)
+        logger.debug("  [DONE]")
+        await sio.emit("done", _DONE_OK, to=sid)
 
     except Exception as e:
-        print(f"  [ERROR] {e}")
+        logger.error("  [ERROR] %s", e)
         await sio.emit("error", {"message": str(e)}, to=sid)
 
+    finally:
+        await state["tokens"].close()
+
 
 # ============================================================
 # HTML 테스트 페이지
@@ -324,8 +600,9 @@ HTML_PAGE = """
             log(`✅ [${data.node.toUpperCase()}] 완료`, 'node-end');
         });
 
-        socket.on('token', (data) => {
-            appendToken(data.content);
+        // 토큰: 첫 글자는 노드 코드 (1: analyzer, 2: generator, 3: saver)
+        socket.on('t', (data) => {
+            appendToken(data.slice(1));
         });
 
         socket.on('db_save', (data) => {
@@ -363,8 +640,21 @@ HTML_PAGE = """
 """
 
 
+# 요청마다 인코딩/압축하지 않도록 미리 bytes로 만들어 둠
+HTML_BYTES = HTML_PAGE.encode("utf-8")
+HTML_GZ = gzip.compress(HTML_BYTES, compresslevel=6)
+HTML_HEADERS = {
+    "Content-Type": "text/html; charset=utf-8",
+    "Cache-Control": "public, max-age=3600",
+    "Vary": "Accept-Encoding",
+}
+HTML_GZ_HEADERS = {**HTML_HEADERS, "Content-Encoding": "gzip"}
+
+
 async def index(request):
-    return web.Response(text=HTML_PAGE, content_type="text/html")
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        return web.Response(body=HTML_GZ, headers=HTML_GZ_HEADERS)
+    return web.Response(body=HTML_BYTES, headers=HTML_HEADERS)
 
 
 app.router.add_get("/", index)
@@ -384,4 +674,5 @@ if __name__ == "__main__":
     print()
     print("🚀 서버 시작: http://localhost:8000")
     print("=" * 60)
-    web.run_app(app, host="0.0.0.0", port=8000)
+    loop = uvloop.new_event_loop() if uvloop else None
+    web.run_app(app, host="0.0.0.0", port=8000, loop=loop)